@@ -1,20 +1,41 @@
 import numpy as np
+import os
+import pytest
+import runpy
+import sys
+
+from scipy.integrate import solve_ivp
 
 from qutip import basis, snot, controlled_gate, sigmaz, tensor, rand_ket
+from qutip import qeye, sigmax, ket2dm, liouvillian
 
 # functions related to quantum mechanical concepts
+import qm
 from qm import bloch
 from qm import deriveUnitary
 from qm import evolve
-from qm import Sz
+from qm import Sy, Sz
+from qm import toVector
+from qm import localTerms
+from qm import liouvillianMatrix
+from qm import applyEnsemble
 
 # Hamiltonian generators
 from hamiltonians import constructHadamardH
 from hamiltonians import constructHadamardCorr
 from hamiltonians import constructCZH
 
+# pulse envelopes
+from pulses import squareEnvelope
+from pulses import rampEnvelope
+from pulses import gaussianEnvelope
+from pulses import delayedEnvelope
+from pulses import timingErrors
+
 # helper functions
 from helpers import are_close
+from helpers import osum
+from helpers import validatePrecision
 
 # functions that generate our circuit and time evolutions
 from teleportation import continuousTeleportationSimulation
@@ -26,10 +47,28 @@ from teleportation import circuitXXBraidingCorrectionSimulation
 from teleportation import circuitZBraidingCorrectionSimulation
 from teleportation import circuitDecodingSimulation
 from teleportation import simulateTeleportation
+from teleportation import scheduledTimeEvolution
+from teleportation import averageTeleportation
+from teleportation import ensembleFidelity
 
 z0, z1, xp, xm, yp, ym = bloch(basis(2, 0), basis(2, 1))
 
 
+# three stages on two qubits with evolution times ts, the last
+# one followed by a correction, for sensitivity and ensemble tests
+def twoQubitSchedule(ts):
+    N = 2
+    return [
+        (osum([Sy(N, i) for i in [0, 1]]), None, ts[0]),
+        (constructCZH(N, [0], [1]), None, ts[1]),
+        (
+            constructHadamardH(N, [0, 1]),
+            constructHadamardCorr(N, [0, 1]),
+            ts[2]
+        )
+    ]
+
+
 class TestCZandH(object):
     def testHadamardUnitary(self):
         H = constructHadamardH(1, [0])
@@ -102,6 +141,260 @@ class TestCZandH(object):
         assert H2.isherm
 
 
+class TestPulses(object):
+    def testRampHadamard(self):
+        H = constructHadamardH(1, [0])
+        U = snot()
+        Ucorr = constructHadamardCorr(1, [0])
+        for psi0 in [z0, z1, xp, xm, yp, ym, rand_ket(2)]:
+            psiu = U*psi0
+            psif = evolve(H, np.pi/2., psi0, envelope=rampEnvelope(0.3))
+            psic = Ucorr*psif
+            overl = psiu.overlap(psic)
+            assert are_close(overl, 1., atol=1e-04)
+
+    def testGaussianCZ(self):
+        H = constructCZH(2, [0], [1])
+        U = controlled_gate(sigmaz(), N=2, control=0, target=1)
+        for psiA in [z0, z1, xp, yp]:
+            for psiB in [xp, xm, ym]:
+                psi0 = tensor([psiA, psiB])
+                psiu = U*psi0
+                psic = evolve(H, np.pi/2., psi0, envelope=gaussianEnvelope(0.3))
+                overl = psiu.overlap(psic)
+                assert are_close(overl, 1., atol=1e-04)
+
+    def testNegativeTimeSchedule(self):
+        H = osum([Sy(2, i) for i in [0, 1]])
+        schedule = [(H, None, -np.pi/2.)]
+        for psi0 in [tensor([z0, xp]), tensor([ym, z1])]:
+            psis = scheduledTimeEvolution(psi0, schedule)
+            psir = scheduledTimeEvolution(
+                psi0, schedule, envelope=rampEnvelope(0.2))
+            overl = psis.overlap(psir)
+            assert are_close(np.abs(overl), 1., atol=1e-04)
+
+    def testNegativeTimeDissipative(self):
+        H = osum([Sy(2, i) for i in [0, 1]])
+        c_ops = [np.sqrt(0.2)*Sz(2, i) for i in range(2)]
+        schedule = [(H, None, -np.pi/2.)]
+        for psi0 in [tensor([z0, xp]), tensor([ym, z1])]:
+            rhos = scheduledTimeEvolution(psi0, schedule, c_ops=c_ops)
+            rhoe = scheduledTimeEvolution(
+                psi0, schedule, c_ops=c_ops, envelope=squareEnvelope())
+            assert (rhos - rhoe).norm() < 1e-04
+            # decoherence acts forward in time and lowers the purity
+            assert (rhos*rhos).tr() < 1.
+
+    def testDelayedPulse(self):
+        H = constructHadamardH(1, [0])
+        U = snot()
+        Ucorr = constructHadamardCorr(1, [0])
+        psi0 = z0
+        psiu = U*psi0
+        envelope = delayedEnvelope(rampEnvelope(0.1), 0.2)
+        psic = Ucorr*evolve(H, np.pi/2., psi0, envelope=envelope)
+        assert np.abs(psiu.overlap(psic)) < 1. - 1e-03
+
+
+class TestSensitivity(object):
+    def testFiniteDifferences(self):
+        N = 2
+        gamma = 0.1
+        h = 1e-04
+        ts = [np.pi/2., np.pi, -np.pi/2.]
+        dc_ops = [Sz(N, i) for i in range(N)]
+        psi0 = tensor([xp, z0])
+
+        def run(ts, gamma):
+            c_ops = [np.sqrt(gamma)*c for c in dc_ops]
+            return scheduledTimeEvolution(
+                psi0, twoQubitSchedule(ts), c_ops=c_ops)
+
+        c_ops = [np.sqrt(gamma)*c for c in dc_ops]
+        rho, tangents = scheduledTimeEvolution(
+            psi0, twoQubitSchedule(ts), c_ops=c_ops,
+            sensitivity=True, dc_ops=dc_ops, name='test')
+        assert (rho - run(ts, gamma)).norm() < 1e-04
+        fd = (run(ts, gamma + h) - run(ts, gamma - h))/(2.*h)
+        assert (fd - tangents['gamma']).norm() < 1e-03
+        for i in range(len(ts)):
+            tp = list(ts)
+            tm = list(ts)
+            tp[i] += h
+            tm[i] -= h
+            fd = (run(tp, gamma) - run(tm, gamma))/(2.*h)
+            assert (fd - tangents[('test', i)]).norm() < 1e-03
+
+    def testGammaOnly(self):
+        N = 2
+        gamma = 0.1
+        ts = [np.pi/2., np.pi, -np.pi/2.]
+        dc_ops = [Sz(N, i) for i in range(N)]
+        c_ops = [np.sqrt(gamma)*c for c in dc_ops]
+        psi0 = tensor([xp, z0])
+        results = [scheduledTimeEvolution(
+            psi0, twoQubitSchedule(ts), c_ops=c_ops, sensitivity=True,
+            dc_ops=dc_ops, name='test', times=times) for times in [True, False]]
+        (rho, tangents), (rhog, tangentsg) = results
+        assert list(tangentsg.keys()) == ['gamma']
+        assert (rho - rhog).norm() < 1e-12
+        assert (tangents['gamma'] - tangentsg['gamma']).norm() < 1e-12
+
+
+class TestEnsemble(object):
+    def testSamplesMatchSingleRuns(self):
+        N = 2
+        gamma = 0.1
+        ts = [np.pi/2., np.pi, -np.pi/2.]
+        c_ops = [np.sqrt(gamma)*Sz(N, i) for i in range(N)]
+        psi0 = tensor([xp, z0])
+        ensemble = timingErrors(0.05, 4, seed=0)
+        states = scheduledTimeEvolution(
+            psi0, twoQubitSchedule(ts), c_ops=c_ops, ensemble=ensemble, name='test')
+        for k in range(4):
+            tk = [t*(1. + ensemble(('test', i))[k]) for i, t in enumerate(ts)]
+            rho = scheduledTimeEvolution(psi0, twoQubitSchedule(tk), c_ops=c_ops)
+            assert np.max(np.abs(toVector(rho) - states[:, k])) < 1e-04
+
+    def testAveragedMatchesQuadrature(self):
+        N = 2
+        gamma = 0.1
+        sigma = 0.1
+        ts = [np.pi/2., np.pi, -np.pi/2.]
+        c_ops = [np.sqrt(gamma)*Sz(N, i) for i in range(N)]
+        psi0 = tensor([xp, z0])
+        rho = scheduledTimeEvolution(
+            psi0, twoQubitSchedule(ts), c_ops=c_ops, jitter=sigma)
+        # Gauss-Hermite product grid over the errors of the three stages
+        x, w = np.polynomial.hermite_e.hermegauss(6)
+        w = w/np.sqrt(2.*np.pi)
+        grid = np.array(np.meshgrid(x, x, x, indexing='ij')).reshape(3, -1)
+        weights = np.array(np.meshgrid(w, w, w, indexing='ij')).reshape(3, -1)
+        weights = np.prod(weights, axis=0)
+
+        def ensemble(key):
+            return sigma*grid[key[1]]
+        states = scheduledTimeEvolution(
+            psi0, twoQubitSchedule(ts), c_ops=c_ops, ensemble=ensemble, name='test')
+        assert np.max(np.abs(toVector(rho) - states.dot(weights))) < 1e-05
+        # the average is not the nominal evolution
+        rho0 = scheduledTimeEvolution(psi0, twoQubitSchedule(ts), c_ops=c_ops)
+        assert (rho - rho0).norm() > 1e-03
+
+    def testStandardError(self):
+        f = np.array([0.9, 0.8, 0.95, 0.85])
+        mean, err = ensembleFidelity(f, np.ones(4))
+        assert are_close(mean, 0.875)
+        assert are_close(err, np.sqrt(np.sum((f - 0.875)**2)/3.)/2.)
+        assert ensembleFidelity(f[:1], np.ones(1)) == (0.9, 0.)
+
+
+class TestPrecision(object):
+    def testSingleStates(self):
+        N = 2
+        gamma = 0.1
+        ts = [np.pi/2., np.pi, -np.pi/2.]
+        c_ops = [np.sqrt(gamma)*Sz(N, i) for i in range(N)]
+        psi0 = tensor([yp, z1])
+        states = {}
+        for dtype in [np.complex128, np.complex64]:
+            states[dtype] = scheduledTimeEvolution(
+                psi0, twoQubitSchedule(ts), c_ops=c_ops,
+                ensemble=timingErrors(0.05, 3, seed=0), dtype=dtype,
+                name='test')
+        assert states[np.complex64].dtype == np.complex64
+        drift = np.abs(states[np.complex64] - states[np.complex128])
+        assert np.max(drift) < 1e-05
+
+    def testValidation(self):
+        def run(x, dtype):
+            return [np.float32(x) if dtype == np.complex64 else x]
+        points = [0.1, 0.2, 0.3]
+        results = [run(x, np.complex64) for x in points]
+        drifts = validatePrecision(run, points, results, samples=3)
+        assert len(drifts) == 3
+        assert all(drift < 1e-04 for i, drift in drifts)
+
+    def testGenerators(self):
+        N = 2
+        H = Sy(N, 0)*Sz(N, 1)
+        c_ops = [np.sqrt(0.1)*Sz(N, i) for i in range(N)]
+        L = liouvillianMatrix(H, c_ops, dtype=np.complex64)
+        assert L.dtype == np.complex64
+        assert np.max(np.abs(L - liouvillian(H, c_ops).data)) < 1e-06
+        U = (-1j*H).expm()
+        rho = ket2dm(tensor([yp, xm]))
+        states = toVector(rho).astype(np.complex64)[:, None]
+        states = applyEnsemble(U, states)
+        assert states.dtype == np.complex64
+        assert np.max(np.abs(states[:, 0] - toVector(U.dag()*rho*U))) < 1e-06
+
+    def testScriptValidation(self, tmp_path, monkeypatch):
+        # fidelity.py reruns its point in double precision, a tiny
+        # tolerance makes it report the drift it has found
+        output = str(tmp_path / 'fidelity.npy')
+        monkeypatch.setattr(sys, 'argv', [
+            'fidelity.py', 'xp', output, '--res', '1',
+            '--precision', 'single', '--validate', '1', '--tol', '1e-12',
+            '--seed', '0'])
+        with pytest.warns(UserWarning, match='drifts by') as record:
+            runpy.run_path(
+                os.path.join(os.path.dirname(__file__), 'fidelity.py'),
+                run_name='__main__')
+        messages = [str(w.message) for w in record if 'drifts by' in str(w.message)]
+        assert len(messages) == 1
+        assert float(messages[0].split('drifts by ')[1].split()[0]) < 1e-04
+        assert np.load(output).shape == (3, 1)
+
+
+class TestMatrixFree(object):
+    def testLocalTerms(self):
+        H = constructCZH(3, [0], [2]) + constructHadamardH(3, [1])
+        terms, identity = localTerms(H)
+        assert sorted(qubits for qubits, M in terms) == [(0,), (0, 2), (1,), (2,)]
+        with pytest.raises(Exception):
+            localTerms(Sz(3, 0)*Sz(3, 1)*Sz(3, 2))
+
+    def testCompareMesolve(self):
+        N = 4
+        gamma = 0.1
+        c_ops = [np.sqrt(gamma)*Sz(N, i) for i in range(N)]
+        psi0 = tensor([xp, z0, ym, z1])
+        Hs = [
+            constructHadamardH(N, range(N)),
+            constructCZH(N, [0, 2], [1, 3]),
+            osum([Sy(N, i) for i in [1, 2]])
+        ]
+        for H in Hs:
+            for ops in [[], c_ops]:
+                psim = evolve(H, -np.pi/4., psi0, c_ops=ops)
+                psif = evolve(
+                    H, -np.pi/4., psi0, c_ops=ops, method='matrixfree')
+                assert (psim - psif).norm() < 1e-04
+
+    def testFinalStateOnly(self, monkeypatch):
+        # the solver must not store a state per step, longer
+        # evolutions take more steps but keep a single state
+        calls = []
+
+        def solver(*args, **kwargs):
+            result = solve_ivp(*args, **kwargs)
+            calls.append((result.y.shape[1], result.nfev))
+            return result
+        monkeypatch.setattr(qm, 'solve_ivp', solver)
+        N = 3
+        c_ops = [np.sqrt(0.1)*Sz(N, i) for i in range(N)]
+        H = osum([Sy(N, i) for i in range(N)])
+        psi0 = tensor([xp, z0, ym])
+        for t in [np.pi/4., 4.*np.pi]:
+            evolve(H, t, psi0, c_ops=c_ops, method='matrixfree')
+        assert calls[1][1] > calls[0][1]
+        assert [stored for stored, nfev in calls] == [1, 1]
+        psif = evolve(H, 0., psi0, c_ops=c_ops, method='matrixfree')
+        assert (psif - ket2dm(psi0)).norm() < 1e-12
+
+
 class TestCompareCircuitEvolutions(object):
     def test_teleportation_component(self):
         states = [z0, z1, xp, xm, yp, ym, rand_ket(2)]
@@ -123,6 +416,120 @@ class TestCompareCircuitEvolutions(object):
             assert are_close(fidelity0000, 1.)
             assert are_close(fidelity, 1.)
 
+    def test_average_unitary_teleportation(self):
+        fidelity0000, fidelity = averageTeleportation(
+            circuitTeleportationSimulation,
+            circuitXXBraidingCorrectionSimulation,
+            circuitZBraidingCorrectionSimulation,
+            circuitDecodingSimulation)
+        assert are_close(fidelity0000, 1.)
+        assert are_close(fidelity, 1.)
+
+    def test_branch_policies(self):
+        # correlated error after encoding, the bit flip of qubit 0
+        # populates branches of the first measurement that are
+        # empty without noise and the phase flip of qubit 5 makes
+        # teleportation fail in all of them
+        q = 0.1
+        E = tensor([sigmax()] + [qeye(2)]*4 + [sigmaz()] + [qeye(2)]*2)
+
+        def noisyTeleportation(psi0, c_ops=[]):
+            rho = ket2dm(circuitTeleportationSimulation(psi0))
+            return (1. - q)*rho + q*E*rho*E
+
+        # circuits multiply by U, rho goes to U (U rho)^dag^dag
+        def conjugated(F):
+            def Fdm(rho, c_ops=[]):
+                return F(F(rho).dag()).dag()
+            return Fdm
+
+        def simulate(**kwargs):
+            return simulateTeleportation(
+                xp,
+                noisyTeleportation,
+                conjugated(circuitXXBraidingCorrectionSimulation),
+                conjugated(circuitZBraidingCorrectionSimulation),
+                conjugated(circuitDecodingSimulation),
+                **kwargs)
+        exact = simulate()
+        assert are_close(exact[1], 1. - q)
+        # flipped branches have probability q/4 each
+        pruned = simulate(branches='prune', threshold=0.05)
+        assert not are_close(pruned[1], exact[1])
+        for k in range(2):
+            assert abs(pruned[k] - exact[k]) <= pruned[k + 2] + 1e-08
+        sampled = simulate(branches='sample', shots=200, seed=0)
+        assert sampled[3] > 0.
+        for k in range(2):
+            assert abs(sampled[k] - exact[k]) <= 4.*sampled[k + 2] + 1e-08
+        with pytest.raises(Exception):
+            simulate(branches='sample', shots=1)
+        with pytest.raises(Exception):
+            simulate(branches='sample', ensemble=timingErrors(0., 2))
+        with pytest.raises(Exception):
+            simulateTeleportation(
+                xp,
+                circuitTeleportationSimulation,
+                circuitXXBraidingCorrectionSimulation,
+                circuitZBraidingCorrectionSimulation,
+                circuitDecodingSimulation,
+                branches='prune')
+
+    def test_ensemble_teleportation(self):
+        fidelity0000, fidelity, err0000, err = simulateTeleportation(
+            xp,
+            continuousTeleportationSimulation,
+            continuousXXBraidingCorrectionSimulation,
+            continuousZBraidingCorrectionSimulation,
+            continuousDecodingSimulation,
+            ensemble=timingErrors(0.02, 20, seed=0))
+        assert fidelity0000 < 1.
+        assert are_close(fidelity0000, 1., atol=1e-02)
+        assert err0000 > 0.
+
+    def test_single_precision_teleportation(self):
+        fidelities = {}
+        for dtype in [np.complex128, np.complex64]:
+            fidelities[dtype] = simulateTeleportation(
+                xm,
+                continuousTeleportationSimulation,
+                continuousXXBraidingCorrectionSimulation,
+                continuousZBraidingCorrectionSimulation,
+                continuousDecodingSimulation,
+                ensemble=timingErrors(0.02, 5, seed=0), dtype=dtype)
+        for f, f64 in zip(fidelities[np.complex64], fidelities[np.complex128]):
+            assert are_close(f, f64, atol=1e-04)
+
+    def test_average_noisy_teleportation(self):
+        # Pauli channel on the teleported qubit after decoding
+        p, q = 0.1, 0.05
+        Z5 = Sz(8, 5)
+        X5 = tensor([qeye(2)]*5 + [sigmax()] + [qeye(2)]*2)
+
+        def noisyDecoding(psi0, c_ops=[]):
+            rho = ket2dm(circuitDecodingSimulation(psi0))
+            return (1. - p - q)*rho + p*Z5*rho*Z5 + q*X5*rho*X5
+
+        # tetrahedron states, another 2-design
+        tetrahedron = []
+        for x, y, z in [(1, 1, 1), (1, -1, -1), (-1, 1, -1), (-1, -1, 1)]:
+            theta = np.arccos(z/np.sqrt(3.))
+            phi = np.arctan2(y, x)
+            tetrahedron += [
+                np.cos(theta/2.)*z0 + np.exp(1j*phi)*np.sin(theta/2.)*z1]
+        averages = []
+        for states in [None, tetrahedron]:
+            averages += [averageTeleportation(
+                circuitTeleportationSimulation,
+                circuitXXBraidingCorrectionSimulation,
+                circuitZBraidingCorrectionSimulation,
+                noisyDecoding,
+                states=states)]
+        expected = 1. - 2.*(p + q)/3.
+        for fidelity0000, fidelity in averages:
+            assert are_close(fidelity0000, expected)
+            assert are_close(fidelity, expected)
+
     def test_time_teleportation(self):
         states = [z0, z1, xp, xm, yp, ym, rand_ket(2)]
         for psi in states:
@@ -1,6 +1,8 @@
 import numpy as np
 import argparse
 
+from functools import partial
+
 from tqdm import tqdm
 from qutip import basis, rand_ket
 
@@ -14,25 +16,53 @@ from teleportation import continuousXXBraidingCorrectionSimulation
 from teleportation import continuousZBraidingCorrectionSimulation
 from teleportation import continuousDecodingSimulation
 from teleportation import simulateTeleportation
+from teleportation import averageTeleportation
+
+# helper functions
+from helpers import validatePrecision
+
+# pulse envelopes
+from pulses import rampEnvelope
+from pulses import gaussianEnvelope
+from pulses import timingErrors
 
 description = '\n'.join([
     'Majorana braiding circuit simulation',
     'using Lindblad dynamics with decoherence,',
     'by Marek Narozniak (c) GPL-3.0',
     '',
-    'For |psi> argument use z0, z1, xp, xm, yp, ym, rnd strings'
+    'For |psi> argument use z0, z1, xp, xm, yp, ym, rnd strings,',
+    'with --average it can be omitted and fidelity is averaged over',
+    'all the input states'
 ])
 parser = argparse.ArgumentParser(description=description)
-parser.add_argument('psi', type=str, help='state to be teleported')
+parser.add_argument('psi', type=str, nargs='?', default=None, help='state to be teleported, optional with --average')
 parser.add_argument('output', type=str, help='path to output file')
 parser.add_argument('--res', type=int, default=3, help='number of decoherence runs')
 parser.add_argument('--gamma', type=float, default=1.0, help='Maximum decay rate')
+parser.add_argument('--average', action='store_true', help='average fidelity over the Bloch sphere')
+parser.add_argument('--sensitivity', action='store_true', help='also store fidelity derivatives with respect to gamma')
+parser.add_argument('--jitter', type=float, default=0., help='relative error of stage durations')
+parser.add_argument('--samples', type=int, default=20, help='number of timing error samples, 0 averages over them instead')
+parser.add_argument('--seed', type=int, default=None, help='seed of timing errors and sampled branches')
+parser.add_argument('--branches', type=str, default='exhaustive', help='measurement branches: exhaustive, prune, sample')
+parser.add_argument('--threshold', type=float, default=1e-06, help='smallest probability of a pruned branch')
+parser.add_argument('--shots', type=int, default=100, help='number of sampled branches')
+parser.add_argument('--precision', type=str, default='double', help='precision of states: double, single')
+parser.add_argument('--validate', type=int, default=1, help='number of points rerun in double precision')
+parser.add_argument('--tol', type=float, default=1e-04, help='tolerated drift of single precision fidelities')
+parser.add_argument('--method', type=str, default='mesolve', help='solver: mesolve, matrixfree')
+parser.add_argument('--pulse', type=str, default='square', help='pulse shape: square, ramp, gaussian')
+parser.add_argument('--width', type=float, default=0.1, help='ramp rise time or gaussian width')
 
 args = parser.parse_args()
 
-if args.psi not in ['z0', 'z1', 'xp', 'xm', 'yp', 'ym', 'rnd']:
+if not args.average and args.psi not in ['z0', 'z1', 'xp', 'xm', 'yp', 'ym', 'rnd']:
     raise Exception('Your input state to be teleported must be one of: z0, z1, xp, xm, yp, ym, rnd')
 
+if args.pulse not in ['square', 'ramp', 'gaussian']:
+    raise Exception('Your pulse shape must be one of: square, ramp, gaussian')
+
 z0, z1, xp, xm, yp, ym = bloch(basis(2, 0), basis(2, 1))
 inp = {
     'z0': z0,
@@ -50,21 +80,118 @@ nb = args.res
 gmax = args.gamma
 gs = np.linspace(0., gmax, nb)
 
-psi = inp[args.psi]
+psi = inp.get(args.psi)
+
+envelopes = {
+    'square': None,
+    'ramp': rampEnvelope(args.width),
+    'gaussian': gaussianEnvelope(args.width)
+}
+envelope = envelopes[args.pulse]
+
+if args.sensitivity and envelope is not None:
+    raise Exception('Sensitivity mode supports square pulses only')
+
+if args.jitter > 0. and (args.sensitivity or envelope is not None):
+    raise Exception('Timing errors are supported for square pulses only')
+
+if args.jitter > 0. and (args.samples < 0 or args.samples == 1):
+    raise Exception('Timing errors need at least two samples, or zero to average over them')
+
+# timing errors are sampled or, with zero samples, averaged over
+sampled = args.jitter > 0. and args.samples > 0
+averaged = args.jitter > 0. and args.samples == 0
+
+if args.branches not in ['exhaustive', 'prune', 'sample']:
+    raise Exception('Your branch policy must be one of: exhaustive, prune, sample')
+
+if args.branches == 'sample' and args.shots < 2:
+    raise Exception('Sampling branches needs at least two shots')
+
+if args.branches != 'exhaustive' and (args.average or args.sensitivity or args.jitter > 0.):
+    raise Exception('Branch policies are supported for single input states only')
 
-results = np.zeros((3, nb))
+if args.precision not in ['double', 'single']:
+    raise Exception('Your precision must be one of: double, single')
+
+if args.precision == 'single' and (args.sensitivity or args.branches != 'exhaustive' or envelope is not None or averaged):
+    raise Exception('Single precision is supported for square pulses without sensitivity, branch policies or averaged timing errors')
+
+# rows are gamma, post-selected and general fidelity,
+# in sensitivity mode followed by their gamma derivatives,
+# with sampled timing errors or branch policies followed by their errors
+rows = 3
+if args.sensitivity or sampled or args.branches != 'exhaustive':
+    rows = 5
+results = np.zeros((rows, nb))
 results[0, :] = gs
 
+if args.method not in ['mesolve', 'matrixfree']:
+    raise Exception('Your solver must be one of: mesolve, matrixfree')
+
+if args.method != 'mesolve' and (args.sensitivity or args.jitter > 0. or args.precision != 'double'):
+    raise Exception('Matrix free solver supports plain double precision runs only')
+
+opts = {'envelope': envelope, 'method': args.method}
+Ftel = partial(continuousTeleportationSimulation, **opts)
+FXX = partial(continuousXXBraidingCorrectionSimulation, **opts)
+FZ = partial(continuousZBraidingCorrectionSimulation, **opts)
+Fdec = partial(continuousDecodingSimulation, **opts)
+
+# same timing errors and branch samples for every gamma
+seed = args.seed
+if seed is None:
+    seed = np.random.randint(2**31)
+
+dtypes = {
+    'double': np.complex128,
+    'single': np.complex64
+}
+dtype = dtypes[args.precision]
+
+
+def run(gamma, dtype):
+    dc_ops = [Sz(N, j) for j in range(N)]
+    c_ops = [np.sqrt(gamma)*c for c in dc_ops]
+    ensemble = None
+    jitter = 0.
+    if sampled:
+        ensemble = timingErrors(args.jitter, args.samples, seed=seed)
+    elif averaged:
+        jitter = args.jitter
+    elif args.precision == 'single':
+        # single runs in both precisions take the same array path
+        # so that the validation compares precision only
+        ensemble = timingErrors(0., 1)
+    # only gamma derivatives are stored, so stage times get no tangents
+    if args.average:
+        return averageTeleportation(
+            Ftel, FXX, FZ, Fdec, c_ops=c_ops,
+            sensitivity=args.sensitivity, dc_ops=dc_ops, ensemble=ensemble,
+            dtype=dtype, times=False, jitter=jitter)
+    return simulateTeleportation(
+        psi, Ftel, FXX, FZ, Fdec, c_ops=c_ops,
+        sensitivity=args.sensitivity, dc_ops=dc_ops, ensemble=ensemble,
+        branches=args.branches, threshold=args.threshold,
+        shots=args.shots, seed=seed, dtype=dtype, times=False,
+        jitter=jitter)
+
+
 for i, gamma in enumerate(tqdm(gs)):
-    c_ops = [np.sqrt(gamma)*Sz(N, j) for j in range(N)]
-    f0000, fall = simulateTeleportation(
-        psi,
-        continuousTeleportationSimulation,
-        continuousXXBraidingCorrectionSimulation,
-        continuousZBraidingCorrectionSimulation,
-        continuousDecodingSimulation,
-        c_ops=c_ops)
-    results[1, i] = f0000
-    results[2, i] = fall
+    res = run(gamma, dtype)
+    results[1, i] = res[0]
+    results[2, i] = res[1]
+    if args.sensitivity:
+        results[3, i] = res[2]['gamma']
+        results[4, i] = res[3]['gamma']
+    if sampled or args.branches != 'exhaustive':
+        results[3, i] = res[2]
+        results[4, i] = res[3]
+
+if dtype != np.complex128:
+    # rerun some of the points in double precision, warns on drift
+    validatePrecision(
+        lambda gamma, dtype: run(gamma, dtype)[:2], gs, results[1:3, :].T,
+        samples=args.validate, atol=args.tol, seed=seed)
 
 np.save(args.output, np.array(results))
@@ -1,4 +1,5 @@
 import numpy as np
+import warnings
 
 
 def are_close(val1, val2, atol=1e-08):
@@ -7,3 +8,20 @@ def are_close(val1, val2, atol=1e-08):
 
 def osum(lst):
     return np.sum(np.array(lst, dtype=object))
+
+
+# reruns a random sample of points in double precision and warns
+# about the ones whose results drift from the given ones beyond atol,
+# run(point, dtype) returns a sequence of values, returns the drifts
+def validatePrecision(run, points, results, samples=1, atol=1e-04, seed=None):
+    rng = np.random.RandomState(seed)
+    samples = min(samples, len(points))
+    drifts = []
+    for i in rng.choice(len(points), size=samples, replace=False):
+        ref = np.real(np.array(run(points[i], np.complex128)))
+        drift = np.max(np.abs(ref - np.real(np.array(results[i]))))
+        if drift > atol:
+            warnings.warn(
+                'point %s drifts by %g in reduced precision' % (points[i], drift))
+        drifts += [(i, drift)]
+    return drifts
@@ -0,0 +1,62 @@
+import numpy as np
+
+from scipy.special import erf
+
+
+# envelopes are functions of a time grid and a stage duration T
+# returning the amplitude of the Hamiltonian at every point of the grid,
+# they are evaluated once per stage so they must be vectorized in times
+# all the shapes are normalized so that the pulse area equals T, this way
+# a shaped stage implements the same rotation as a square one
+
+
+def squareEnvelope():
+    def envelope(times, T):
+        return np.where((times >= 0.) & (times <= T), 1., 0.)
+    return envelope
+
+
+def rampEnvelope(rise):
+    def envelope(times, T):
+        r = min(rise, T/2.)
+        if r <= 0.:
+            return squareEnvelope()(times, T)
+        shape = np.clip(np.minimum(times, T - times)/r, 0., 1.)
+        # area of the trapezoid is T - r
+        return shape*T/(T - r)
+    return envelope
+
+
+def gaussianEnvelope(sigma):
+    def envelope(times, T):
+        shape = np.exp(-(times - T/2.)**2/(2.*sigma**2))
+        shape = np.where((times >= 0.) & (times <= T), shape, 0.)
+        # area of the gaussian truncated to the [0, T] window
+        area = sigma*np.sqrt(2.*np.pi)*erf(T/(2.*np.sqrt(2.)*sigma))
+        return shape*T/area
+    return envelope
+
+
+# timing jitter, the pulse is triggered delta too late (or too early)
+# and gets truncated by the stage window, so it loses part of its area
+def delayedEnvelope(envelope, delta):
+    def delayed(times, T):
+        shifted = times - delta
+        inside = (shifted >= 0.) & (shifted <= T)
+        return np.where(inside, envelope(shifted, T), 0.)
+    return delayed
+
+
+# calibration errors of stage durations, every stage (identified by
+# a key) gets its own relative errors drawn once for all the samples,
+# the same stage evaluated again reuses them, as a miscalibrated
+# pulse would be the same in every branch of a run
+def timingErrors(sigma, samples, seed=None):
+    rng = np.random.RandomState(seed)
+    errors = {}
+
+    def offsets(key):
+        if key not in errors:
+            errors[key] = sigma*rng.standard_normal(samples)
+        return errors[key]
+    return offsets
@@ -1,7 +1,12 @@
 import numpy as np
 import itertools
 
-from qutip import basis, tensor, Options, mesolve
+from scipy.sparse import bmat, csr_matrix, identity, kron
+from scipy.sparse.linalg import expm_multiply
+from scipy.integrate import solve_ivp
+
+from qutip import basis, tensor, Options, mesolve, Qobj, ket2dm
+from qutip import liouvillian, lindblad_dissipator
 from qutip import qeye, sigmax, sigmay, sigmaz
 
 
@@ -68,8 +73,357 @@ def pmeasurement(psi, register, normalize=True):
     return outcomes, projectors, confs
 
 
-def evolve(H, t, psi, res=200, c_ops=[]):
+# probability of an unnormalized outcome of pmeasurement
+def branchProbability(psi):
+    if psi.dims[1][0] == 1:
+        return psi.norm()**2
+    return np.real(psi.tr())
+
+
+# negative evolution times reverse the Hamiltonian instead of
+# the time, so decoherence always acts forward in time
+def forwardTime(H, t):
+    if t < 0.:
+        return -H, -t
+    return H, t
+
+
+def evolve(H, t, psi, res=200, c_ops=[], envelope=None, method='mesolve'):
+    H, t = forwardTime(H, t)
+    if method == 'matrixfree':
+        return evolveMatrixFree(H, t, psi, res=res, c_ops=c_ops, envelope=envelope)
+    if method != 'mesolve':
+        raise Exception('Evolution method must be one of: mesolve, matrixfree')
     opts = Options(store_final_state=True)
+    if envelope is None:
+        times = np.linspace(0., t, res)
+        result = mesolve(H, psi, times, c_ops, options=opts)
+        return result.final_state
+    # pulse shaped evolution, the envelope is sampled once on the time grid
+    # and passed as an array coefficient, so the solver interpolates it
+    # in compiled code instead of calling back into Python at every step
     times = np.linspace(0., t, res)
-    result = mesolve(H, psi, times, c_ops, options=opts)
+    coeffs = envelope(times, t)
+    result = mesolve([[H, coeffs]], psi, times, c_ops, options=opts)
     return result.final_state
+
+
+# column stacking of a density matrix, as used by qutip superoperators
+def toVector(rho):
+    return rho.full().T.ravel()
+
+
+def fromVector(vec, dims):
+    d = int(np.sqrt(len(vec)))
+    return Qobj(vec.reshape(d, d).T, dims=dims)
+
+
+# evolves density matrix rho together with its derivatives (tangents)
+# with respect to the model parameters, collapse operators are assumed
+# to be c_ops = sqrt(gamma)*dc_ops so the gamma derivative of the
+# Lindbladian is the dissipator of dc_ops, the gamma tangent is
+# propagated with the block generator [[L, 0], [dL, L]] in the same
+# exponential as the state, returns the final state, its tangents
+# and its derivative with respect to the evolution time t
+def evolveSensitivity(H, t, rho, tangents, c_ops=[], dc_ops=[]):
+    sign = -1. if t < 0. else 1.
+    H, t = forwardTime(H, t)
+    if rho.dims[1][0] == 1:
+        rho = ket2dm(rho)
+    d = rho.shape[0]
+    L = csr_matrix(liouvillian(H, c_ops).data)
+    dL = csr_matrix((d*d, d*d), dtype=complex)
+    for c in dc_ops:
+        dL = dL + csr_matrix(lindblad_dissipator(c).data)
+    vec = toVector(rho)
+    dvec = np.zeros(d*d, dtype=complex)
+    if 'gamma' in tangents:
+        dvec = toVector(tangents['gamma'])
+    aug = expm_multiply(t*bmat([[L, None], [dL, L]], format='csr'),
+                        np.concatenate([vec, dvec]))
+    vec, dvec = aug[:d*d], aug[d*d:]
+    result = {'gamma': fromVector(dvec, rho.dims)}
+    keys = [k for k in tangents if k != 'gamma']
+    if len(keys) > 0:
+        cols = np.column_stack([toVector(tangents[k]) for k in keys])
+        cols = expm_multiply(t*L, cols)
+        for i, k in enumerate(keys):
+            result[k] = fromVector(cols[:, i], rho.dims)
+    drho = fromVector(sign*(L*vec), rho.dims)
+    return fromVector(vec, rho.dims), result, drho
+
+
+# projective measurement of a state carrying tangents,
+# every tangent is projected the same way as the state
+def pmeasurementSensitivity(state, register):
+    rho, tangents = state
+    outcomes, projectors, confs = pmeasurement(rho, register, normalize=False)
+    states = []
+    for rhop, P in zip(outcomes, projectors):
+        states += [(rhop, {k: P*v*P for k, v in tangents.items()})]
+    return states, projectors, confs
+
+
+# Liouvillian in column stacked form built directly in dtype,
+# only operators on the Hilbert space are cast, so no double
+# precision superoperator is ever allocated, matches liouvillian
+def liouvillianMatrix(H, c_ops=[], dtype=np.complex128):
+    I = identity(H.shape[0], dtype=dtype, format='csr')
+    Hd = csr_matrix(H.data, dtype=dtype)
+    L = -1j*(kron(I, Hd) - kron(Hd.T, I))
+    for c in c_ops:
+        cd = csr_matrix(c.data, dtype=dtype)
+        cdc = cd.conj().T*cd
+        L = L + kron(cd.conj(), cd) - 0.5*kron(I, cdc) - 0.5*kron(cdc.T, I)
+    return csr_matrix(L, dtype=dtype)
+
+
+# evolves an ensemble of states stored as columns of an array
+# (state vectors or column stacked density matrices), sample s
+# evolves for time t*(1 + offsets[s]), the nominal evolution is
+# shared by all the samples and the residual one is summed as
+# a Taylor series for all of them at once, the generator is built
+# in the precision of states so complex64 states stay complex64
+def evolveEnsemble(H, t, states, offsets, c_ops=[], tol=None):
+    H, t = forwardTime(H, t)
+    if tol is None:
+        tol = 10.*np.finfo(states.dtype).eps
+    if states.shape[0] == H.shape[0]:
+        G = csr_matrix(-1j*H.data, dtype=states.dtype)
+    else:
+        G = liouvillianMatrix(H, c_ops, dtype=states.dtype)
+    states = expm_multiply(t*G, states)
+    dts = (t*np.asarray(offsets)).astype(states.real.dtype)
+    # split the residual evolution so that every step is short
+    norm = np.max(np.abs(G).sum(axis=0))
+    steps = max(1, int(np.ceil(np.max(np.abs(dts))*norm)))
+    dts = dts/steps
+    for step in range(steps):
+        term = states
+        k = 0
+        while True:
+            k += 1
+            term = (G*term)*(dts/k)
+            states = states + term
+            if np.max(np.abs(term)) < tol:
+                break
+    return states
+
+
+# evolution averaged over relative errors d of the evolution time
+# drawn from a normal distribution of width sigma, all the times
+# share the generator L so the average of exp(t(1 + d)L) is exactly
+# exp(tL) exp((sigma t)^2 L^2/2), the nominal evolution is left to
+# evolve and the second factor is summed as a Taylor series in L^2,
+# returns a density matrix, as averaging mixes state vectors
+def evolveAveraged(H, t, psi, sigma, res=200, c_ops=[]):
+    H, t = forwardTime(H, t)
+    rho = evolve(H, t, psi, res=res, c_ops=c_ops)
+    if rho.dims[1][0] == 1:
+        rho = ket2dm(rho)
+    L = liouvillianMatrix(H, c_ops)
+    s = 0.5*(sigma*t)**2
+    vec = toVector(rho)
+    # split the series so that every step is short
+    norm = np.max(np.abs(L).sum(axis=0))**2
+    steps = max(1, int(np.ceil(s*norm)))
+    tol = 10.*np.finfo(vec.dtype).eps
+    for step in range(steps):
+        term = vec
+        k = 0
+        while True:
+            k += 1
+            term = (L*(L*term))*(s/steps/k)
+            vec = vec + term
+            if np.max(np.abs(term)) < tol:
+                break
+    return fromVector(vec, rho.dims)
+
+
+def applyEnsemble(U, states):
+    Ud = csr_matrix(U.data, dtype=states.dtype)
+    if states.shape[0] == U.shape[0]:
+        return Ud*states
+    # U^dag rho U as sprepost(U.dag(), U), in the precision of states
+    return csr_matrix(kron(Ud.T, Ud.conj().T))*states
+
+
+# projective measurement of an ensemble, projectors are diagonal
+# in the computational basis so they reduce to masks
+def pmeasurementEnsemble(states, register):
+    N = len(register)
+    refval = np.nonzero(register)[0]
+    M = len(refval)
+    confs = list(itertools.product([0, 1], repeat=M))
+    bits = (np.arange(2**N)[:, None] >> (N - 1 - np.arange(N))) & 1
+    outcomes = []
+    masks = []
+    for conf in confs:
+        mask = np.all(bits[:, refval] == conf, axis=1)
+        mask = mask.astype(states.real.dtype)
+        if states.shape[0] != 2**N:
+            # density matrix, element (i, j) survives if both do
+            mask = np.kron(mask, mask)
+        outcomes += [states*mask[:, None]]
+        masks += [mask]
+    return outcomes, masks, confs
+
+
+# overlaps of every sample of the ensemble with a pure state,
+# mirrors the quantities used for single states
+def overlapEnsemble(states, psi):
+    e = psi.full().ravel().astype(states.dtype)
+    d = len(e)
+    if states.shape[0] == d:
+        # state vectors
+        vv = np.abs(e.conj().dot(states))
+        nrm = np.linalg.norm(states, axis=0)
+    else:
+        # density matrices
+        vv = np.real(np.kron(e, e.conj()).dot(states))
+        nrm = np.real(states[::d+1].sum(axis=0))
+    return vv, nrm
+
+
+PAULIS = np.array([
+    qeye(2).full(),
+    sigmax().full(),
+    sigmay().full(),
+    sigmaz().full()
+])
+
+
+# decomposes operator A on N qubits into terms acting on at most
+# two qubits, returns a list of pairs of qubits and matrices on them
+# (the identity component is dropped) together with the identity
+# coefficient, Pauli coefficients are read off the sparse entries
+# and Parseval identity checks that nothing was left out
+def localTerms(A, tol=1e-10):
+    N = len(A.dims[0])
+    coo = A.data.tocoo()
+    rows, cols, vals = coo.row, coo.col, coo.data
+    shifts = N - 1 - np.arange(N)
+    rbits = (rows[:, None] >> shifts) & 1
+    cbits = (cols[:, None] >> shifts) & 1
+    flips = rbits != cbits
+    # Tr(P A) = sum over entries A[r, c] P[c, r]
+    factors = PAULIS[:, cbits, rbits]
+    identity = np.sum(vals[~flips.any(axis=1)])/2**N
+    norm = np.abs(identity)**2
+    terms = []
+    for i in range(N):
+        valid = ~np.delete(flips, i, axis=1).any(axis=1)
+        c = factors[1:, valid, i].dot(vals[valid])/2**N
+        if np.max(np.abs(c)) > tol:
+            terms += [((i,), np.einsum('p,pab->ab', c, PAULIS[1:]))]
+            norm += np.sum(np.abs(c)**2)
+    for i, j in itertools.combinations(range(N), 2):
+        valid = ~np.delete(flips, [i, j], axis=1).any(axis=1)
+        c = np.einsum(
+            'pn,qn,n->pq',
+            factors[1:, valid, i], factors[1:, valid, j], vals[valid])/2**N
+        if np.max(np.abs(c)) > tol:
+            M = np.einsum('pq,pab,qcd->acbd', c, PAULIS[1:], PAULIS[1:])
+            terms += [((i, j), M.reshape(4, 4))]
+            norm += np.sum(np.abs(c)**2)
+    total = np.sum(np.abs(vals)**2)/2**N
+    if total - norm > tol*max(total, 1.):
+        raise Exception('Operator is not a sum of one and two qubit terms')
+    return terms, identity
+
+
+# collapse operator as a single matrix on the qubits it acts on
+def localOperator(A, tol=1e-10):
+    terms, identity = localTerms(A, tol=tol)
+    support = sorted(set(q for qubits, M in terms for q in qubits))
+    if len(support) > 2:
+        raise Exception('Collapse operators must act on at most two qubits')
+    k = len(support)
+    op = identity*np.eye(2**k, dtype=complex)
+    for qubits, M in terms:
+        full = M
+        if len(qubits) < k:
+            # embed a single qubit term into the pair
+            if qubits[0] == support[0]:
+                full = np.kron(M, np.eye(2))
+            else:
+                full = np.kron(np.eye(2), M)
+        op = op + full
+    return tuple(support), op
+
+
+# applies M acting on qubits to the row indices of tensor rho
+def applyLeft(M, qubits, rho):
+    k = len(qubits)
+    Mt = M.reshape((2,)*2*k)
+    out = np.tensordot(Mt, rho, axes=(list(range(k, 2*k)), list(qubits)))
+    return np.moveaxis(out, list(range(k)), list(qubits))
+
+
+# multiplies tensor rho of N qubits by M acting on qubits from the right
+def applyRight(M, qubits, rho, N):
+    k = len(qubits)
+    Mt = M.reshape((2,)*2*k)
+    axes = [N + q for q in qubits]
+    out = np.tensordot(rho, Mt, axes=(axes, list(range(k))))
+    return np.moveaxis(out, list(range(2*N - k, 2*N)), axes)
+
+
+# evolution which never builds the Liouvillian, the Hamiltonian and
+# collapse operators are kept as lists of terms acting on at most two
+# qubits and the Lindbladian is applied to the density matrix reshaped
+# into a tensor with one index per qubit, memory is a few copies of
+# the state, the envelope (if any) is interpolated on the time grid
+def evolveMatrixFree(H, t, psi, res=200, c_ops=[], envelope=None):
+    H, t = forwardTime(H, t)
+    N = len(H.dims[0])
+    hterms, identity = localTerms(H)
+    cterms = [localOperator(c) for c in c_ops]
+    # terms of the effective Hamiltonian grouped by the qubits they
+    # act on, the hermitian part (scaled by the envelope) and the
+    # non-hermitian one coming from collapse operators
+    groups = {}
+    for qubits, M in hterms:
+        groups[qubits] = [M, 0.]
+    for qubits, c in cterms:
+        if qubits not in groups:
+            groups[qubits] = [0., 0.]
+        groups[qubits][1] = groups[qubits][1] - 0.5j*c.conj().T.dot(c)
+    times = None
+    if envelope is not None:
+        times = np.linspace(0., t, res)
+        samples = envelope(times, t)
+    if len(c_ops) > 0 and psi.dims[1][0] == 1:
+        psi = ket2dm(psi)
+    ket = psi.dims[1][0] == 1
+    shape = (2,)*N if ket else (2,)*2*N
+
+    def rhs(s, y):
+        rho = y.reshape(shape)
+        f = 1.
+        if times is not None:
+            f = np.interp(s, times, samples)
+        out = np.zeros(shape, dtype=complex)
+        if ket:
+            # global phase, cancels out for density matrices
+            out += -1j*f*identity*rho
+        for qubits, (M, D) in groups.items():
+            K = f*M + D
+            out += -1j*applyLeft(K, qubits, rho)
+            if not ket:
+                out += 1j*applyRight(np.conj(K).T, qubits, rho, N)
+        for qubits, c in cterms:
+            crho = applyLeft(c, qubits, rho)
+            out += applyRight(c.conj().T, qubits, crho, N)
+        return out.ravel()
+
+    y = psi.full().ravel()
+    if t > 0.:
+        # only the final state is kept, not one per solver step
+        result = solve_ivp(
+            rhs, (0., t), y, t_eval=[t], rtol=1e-6, atol=1e-8)
+        y = result.y[:, -1]
+    if ket:
+        return Qobj(y.reshape(-1, 1), dims=psi.dims)
+    d = psi.shape[0]
+    return Qobj(y.reshape(d, d), dims=psi.dims)
@@ -1,10 +1,17 @@
 import numpy as np
 
+from functools import partial
+
+from qutip import Qobj, ket2dm
 from qutip import basis, controlled_gate, tensor, expect
 from qutip import sigmaz, snot, rx, ry, rz
 
 # functions related to quantum mechanical concepts
-from qm import evolve, pmeasurement
+from qm import evolve, pmeasurement, branchProbability
+from qm import evolveSensitivity, pmeasurementSensitivity
+from qm import evolveEnsemble, applyEnsemble, toVector, evolveAveraged
+from qm import pmeasurementEnsemble, overlapEnsemble
+from qm import bloch
 from qm import Sx, Sy, Sz
 
 # Hamiltonian generators
@@ -12,6 +19,9 @@ from hamiltonians import constructHadamardH
 from hamiltonians import constructHadamardCorr
 from hamiltonians import constructCZH
 
+# timing errors
+from pulses import timingErrors
+
 # helper functions
 from helpers import osum
 
@@ -29,14 +39,50 @@ def scheduledUnitaryEvolution(psi0, schedule):
 
 # schedule is list of triples where first element is
 # a Hamiltonian, second element is correcting unitary
-# and third element is evolution time
-def scheduledTimeEvolution(psi0, schedule, c_ops=[]):
+# and third element is evolution time, optional fourth
+# element is a pulse envelope (see pulses.py) which
+# overrides the envelope given for the whole schedule,
+# in sensitivity mode derivatives are propagated along
+# (see scheduledSensitivityEvolution, times=False skips
+# the ones with respect to stage times), with ensemble
+# a batch of timing errors (see scheduledEnsembleEvolution),
+# jitter is the width of relative timing errors the evolution
+# is averaged over instead of sampled (see qm.evolveAveraged),
+# method selects the solver of plain runs (see qm.evolve)
+def scheduledTimeEvolution(
+        psi0, schedule, c_ops=[], envelope=None,
+        sensitivity=False, dc_ops=[], ensemble=None, dtype=np.complex128,
+        method='mesolve', name=None, times=True, jitter=0.):
+    if method != 'mesolve' and (sensitivity or ensemble is not None or jitter > 0.):
+        raise Exception('Sensitivity, ensemble and jitter modes have their own solvers')
+    if jitter > 0. and (sensitivity or ensemble is not None or envelope is not None):
+        raise Exception('Averaged timing errors support plain square pulses only')
+    if ensemble is not None:
+        if envelope is not None or sensitivity:
+            raise Exception('Ensemble mode supports square pulses only')
+        return scheduledEnsembleEvolution(
+            psi0, schedule, ensemble, c_ops=c_ops, dtype=dtype, name=name)
+    if sensitivity:
+        if envelope is not None:
+            raise Exception('Sensitivity mode supports square pulses only')
+        return scheduledSensitivityEvolution(
+            psi0, schedule, c_ops=c_ops, dc_ops=dc_ops, name=name,
+            times=times)
     psif = None
-    for H, U, t in schedule:
+    for stage in schedule:
+        H, U, t = stage[:3]
+        env = envelope
+        if len(stage) > 3 and stage[3] is not None:
+            env = stage[3]
         if psif is None:
-            psif = evolve(H, t/2., psi0, c_ops=c_ops)
+            psif = psi0
+        if jitter > 0.:
+            if len(stage) > 3 and stage[3] is not None:
+                raise Exception('Averaged timing errors support square pulses only')
+            psif = evolveAveraged(H, t/2., psif, jitter, c_ops=c_ops)
         else:
-            psif = evolve(H, t/2., psif, c_ops=c_ops)
+            psif = evolve(
+                H, t/2., psif, c_ops=c_ops, envelope=env, method=method)
         if U is not None:
             if psif.dims[1][0] == 1:
                 # state vector
@@ -47,11 +93,70 @@ def scheduledTimeEvolution(psi0, schedule, c_ops=[]):
     return psif
 
 
+# psi0 is a state or a pair of density matrix and dictionary
+# of its derivatives, returns such a pair, derivatives are
+# taken with respect to gamma (key 'gamma') and, unless times is
+# False, to the evolution time of every stage (key (name, index of
+# the stage)), each of these costs another propagated tangent
+def scheduledSensitivityEvolution(
+        psi0, schedule, c_ops=[], dc_ops=[], name=None, times=True):
+    if isinstance(psi0, tuple):
+        rho, tangents = psi0
+    else:
+        rho, tangents = psi0, {}
+    for i, stage in enumerate(schedule):
+        H, U, t = stage[:3]
+        if len(stage) > 3 and stage[3] is not None:
+            raise Exception('Sensitivity mode supports square pulses only')
+        rho, tangents, drho = evolveSensitivity(
+            H, t/2., rho, tangents, c_ops=c_ops, dc_ops=dc_ops)
+        # stage evolves for t/2
+        if times:
+            if (name, i) in tangents:
+                tangents[(name, i)] += 0.5*drho
+            else:
+                tangents[(name, i)] = 0.5*drho
+        if U is not None:
+            rho = U.dag()*rho*U
+            tangents = {k: U.dag()*v*U for k, v in tangents.items()}
+    return rho, tangents
+
+
+# psi0 is a state or an array whose columns are states of the
+# ensemble (see qm.evolveEnsemble), ensemble is a function giving
+# relative timing errors of the samples for a stage identified
+# by (name, index of the stage), see pulses.timingErrors,
+# dtype sets the precision of the whole ensemble
+def scheduledEnsembleEvolution(
+        psi0, schedule, ensemble, c_ops=[], dtype=np.complex128, name=None):
+    states = psi0
+    for i, stage in enumerate(schedule):
+        H, U, t = stage[:3]
+        if len(stage) > 3 and stage[3] is not None:
+            raise Exception('Ensemble mode supports square pulses only')
+        offsets = ensemble((name, i))
+        if isinstance(states, Qobj):
+            if len(c_ops) > 0 and states.dims[1][0] == 1:
+                states = ket2dm(states)
+            if states.dims[1][0] == 1:
+                vec = states.full().ravel()
+            else:
+                vec = toVector(states)
+            states = np.tile(vec[:, None], (1, len(offsets))).astype(dtype)
+        states = evolveEnsemble(H, t/2., states, offsets, c_ops=c_ops)
+        if U is not None:
+            states = applyEnsemble(U, states)
+    return states
+
+
 # takes a quantum state to be teleported
 # and decay rate, produces a state of 8 qubits
 # runs encoding state and teleportation
 # returns a reuslting density operator
-def continuousTeleportationSimulation(psi, c_ops=[]):
+def continuousTeleportationSimulation(
+        psi, c_ops=[], envelope=None, sensitivity=False, dc_ops=[],
+        ensemble=None, dtype=np.complex128, method='mesolve', times=True,
+        jitter=0.):
     N = 8
     psi0 = tensor([basis(2, 0), psi] + [basis(2, 0) for i in range(N-2)])
     schedule = []
@@ -116,7 +221,11 @@ def continuousTeleportationSimulation(psi, c_ops=[]):
         np.pi
     ))
     # perform time evolution and return the final state
-    return scheduledTimeEvolution(psi0, schedule, c_ops=c_ops)
+    return scheduledTimeEvolution(
+        psi0, schedule, c_ops=c_ops, envelope=envelope,
+        sensitivity=sensitivity, dc_ops=dc_ops, ensemble=ensemble,
+        dtype=dtype, method=method, name='teleportation', times=times,
+        jitter=jitter)
 
 
 def circuitTeleportationSimulation(psi, c_ops=[]):
@@ -157,7 +266,10 @@ def circuitTeleportationSimulation(psi, c_ops=[]):
     return scheduledUnitaryEvolution(psi0, schedule)
 
 
-def continuousXXBraidingCorrectionSimulation(psi0, c_ops=[]):
+def continuousXXBraidingCorrectionSimulation(
+        psi0, c_ops=[], envelope=None, sensitivity=False, dc_ops=[],
+        ensemble=None, dtype=np.complex128, method='mesolve', times=True,
+        jitter=0.):
     N = 8
     schedule = []
     for i in range(2):
@@ -185,7 +297,11 @@ def continuousXXBraidingCorrectionSimulation(psi0, c_ops=[]):
             None,
             -np.pi/2.
         ))
-    return scheduledTimeEvolution(psi0, schedule, c_ops=c_ops)
+    return scheduledTimeEvolution(
+        psi0, schedule, c_ops=c_ops, envelope=envelope,
+        sensitivity=sensitivity, dc_ops=dc_ops, ensemble=ensemble,
+        dtype=dtype, method=method, name='XX', times=times,
+        jitter=jitter)
 
 
 def circuitXXBraidingCorrectionSimulation(psi0, c_ops=[]):
@@ -206,7 +322,10 @@ def circuitXXBraidingCorrectionSimulation(psi0, c_ops=[]):
     return scheduledUnitaryEvolution(psi0, schedule)
 
 
-def continuousZBraidingCorrectionSimulation(psi0, c_ops=[]):
+def continuousZBraidingCorrectionSimulation(
+        psi0, c_ops=[], envelope=None, sensitivity=False, dc_ops=[],
+        ensemble=None, dtype=np.complex128, method='mesolve', times=True,
+        jitter=0.):
     N = 8
     schedule = []
     for i in range(2):
@@ -234,7 +353,11 @@ def continuousZBraidingCorrectionSimulation(psi0, c_ops=[]):
             None,
             -np.pi/2.
         ))
-    return scheduledTimeEvolution(psi0, schedule, c_ops=c_ops)
+    return scheduledTimeEvolution(
+        psi0, schedule, c_ops=c_ops, envelope=envelope,
+        sensitivity=sensitivity, dc_ops=dc_ops, ensemble=ensemble,
+        dtype=dtype, method=method, name='Z', times=times,
+        jitter=jitter)
 
 
 def circuitZBraidingCorrectionSimulation(psi0, c_ops=[]):
@@ -255,7 +378,10 @@ def circuitZBraidingCorrectionSimulation(psi0, c_ops=[]):
     return scheduledUnitaryEvolution(psi0, schedule)
 
 
-def continuousDecodingSimulation(psi0, c_ops=[]):
+def continuousDecodingSimulation(
+        psi0, c_ops=[], envelope=None, sensitivity=False, dc_ops=[],
+        ensemble=None, dtype=np.complex128, method='mesolve', times=True,
+        jitter=0.):
     N = 8
     schedule = []
     # decoding, stage 1, 2
@@ -276,7 +402,11 @@ def continuousDecodingSimulation(psi0, c_ops=[]):
         constructHadamardCorr(N, [4, 5, 6]),
         np.pi
     ))
-    return scheduledTimeEvolution(psi0, schedule, c_ops=c_ops)
+    return scheduledTimeEvolution(
+        psi0, schedule, c_ops=c_ops, envelope=envelope,
+        sensitivity=sensitivity, dc_ops=dc_ops, ensemble=ensemble,
+        dtype=dtype, method=method, name='decoding', times=times,
+        jitter=jitter)
 
 
 def circuitDecodingSimulation(psi0, c_ops=[]):
@@ -295,37 +425,82 @@ def circuitDecodingSimulation(psi0, c_ops=[]):
     return scheduledUnitaryEvolution(psi0, schedule)
 
 
-def simulateTeleportation(
+# runs the teleportation of psi and returns the unnormalized
+# overlaps with the expected states together with the
+# probabilities, first for the post-selected outcomes
+# then for all of them, in sensitivity mode it also returns
+# a dictionary with derivatives of these four sums (only the gamma
+# one when times is False), in ensemble
+# mode the sums are arrays with one entry per sample, select
+# chooses the branches of the first measurement to be evolved
+# from their probabilities (see branchWeights), the sums are then
+# weighted and returned with contributions of every branch,
+# dtype is the precision of ensemble states, with jitter the
+# sums are averaged over relative timing errors of that width
+def teleportationAmplitudes(
         psi,
         Ftel,
         FXX,
         FZ,
         Fdec,
-        normalize=True, c_ops=[]):
+        c_ops=[], sensitivity=False, dc_ops=[], ensemble=None,
+        select=None, dtype=np.complex128, times=True, jitter=0.):
+    if select is not None and (sensitivity or ensemble is not None):
+        raise Exception('Branch selection supports plain runs only')
     amZ = 0.  # post-selected amplitudes
     smZ = 0.
     amn = 0.  # all the amplitudes
     smn = 0.
-    psifc = Ftel(psi, c_ops=c_ops)
+    dsums = {}
+    kwargs = {'c_ops': c_ops}
+    measure = partial(pmeasurement, normalize=False)
+    if sensitivity:
+        kwargs['sensitivity'] = True
+        kwargs['dc_ops'] = dc_ops
+        kwargs['times'] = times
+        measure = pmeasurementSensitivity
+    if ensemble is not None:
+        kwargs['ensemble'] = ensemble
+        kwargs['dtype'] = dtype
+        measure = pmeasurementEnsemble
+    if jitter > 0.:
+        kwargs['jitter'] = jitter
+    psifc = Ftel(psi, **kwargs)
     M = [True, True, True, True, False, False, False, False]
-    psis, _, outs = pmeasurement(psifc, M, normalize=False)
-    for psiout, out in zip(psis, outs):
+    psis, _, outs = measure(psifc, M)
+    probabilities = None
+    weights = None
+    if select is not None:
+        # branches are chosen before any correction is evolved
+        probabilities = [branchProbability(p) for p in psis]
+        weights = select(probabilities, kets=psifc.dims[1][0] == 1)
+    contributions = {}
+    for b, (psiout, out) in enumerate(zip(psis, outs)):
+        w = 1.
+        if weights is not None:
+            if b not in weights:
+                continue
+            w = weights[b]
+        bmZ = 0.
+        bsZ = 0.
+        bmn = 0.
+        bsn = 0.
         c1, c2 = out[1], out[3]
         psio = None
         if c1 == 0 and c2 == 0:
-            psio = FZ(psiout, c_ops=c_ops)
+            psio = FZ(psiout, **kwargs)
         if c1 == 0 and c2 == 1:
-            psio = FXX(psiout, c_ops=c_ops)
+            psio = FXX(psiout, **kwargs)
         if c1 == 1 and c2 == 0:
-            psio = FXX(psiout, c_ops=c_ops)
-            psio = FZ(psio, c_ops=c_ops)
+            psio = FXX(psiout, **kwargs)
+            psio = FZ(psio, **kwargs)
         if c1 == 1 and c2 == 1:
             psio = psiout
         # apply the decoding circuit
-        psif = Fdec(psio, c_ops=c_ops)
+        psif = Fdec(psio, **kwargs)
         # perform another projection on remaining qubits
         M = [False, False, False, False, True, False, True, True]
-        mpsis, _, mouts = pmeasurement(psif, M, normalize=False)
+        mpsis, _, mouts = measure(psif, M)
         for mpsif, mout in zip(mpsis, mouts):
             # extract the teleported state
             psiexp = tensor([
@@ -337,9 +512,25 @@ def simulateTeleportation(
                 psi,
                 basis(2, mout[1]),
                 basis(2, mout[2])])
+            postselected = np.count_nonzero(
+                [out[0], out[2], mout[0], mout[1]]) == 0
+            if sensitivity:
+                mpsif, tangents = mpsif
+                for k, v in tangents.items():
+                    # overlap and trace are linear in the state
+                    dvv = np.real(expect(v, psiexp))
+                    dnrm = np.real(v.tr())
+                    if k not in dsums:
+                        dsums[k] = np.zeros(4)
+                    if postselected:
+                        dsums[k] += [dvv, dnrm, dvv, dnrm]
+                    else:
+                        dsums[k] += [0., 0., dvv, dnrm]
             vv = None
             nrm = None
-            if mpsif.dims[1][0] == 1:
+            if ensemble is not None:
+                vv, nrm = overlapEnsemble(mpsif, psiexp)
+            elif mpsif.dims[1][0] == 1:
                 # state vector
                 vv = np.abs(mpsif.overlap(psiexp))
                 nrm = mpsif.norm()
@@ -347,13 +538,221 @@ def simulateTeleportation(
                 # density matrix
                 vv = expect(mpsif, psiexp)
                 nrm = mpsif.tr()
-            if np.count_nonzero([out[0], out[2], mout[0], mout[1]]) == 0:
-                amZ += vv
-                smZ += nrm
-            amn += vv
-            smn += nrm
+            if postselected:
+                bmZ += vv
+                bsZ += nrm
+            bmn += vv
+            bsn += nrm
+        if select is not None:
+            contributions[b] = np.array([bmZ, bsZ, bmn, bsn])
+        amZ += w*bmZ
+        smZ += w*bsZ
+        amn += w*bmn
+        smn += w*bsn
+    if sensitivity:
+        return (amZ, smZ, amn, smn), dsums
+    if select is not None:
+        return (amZ, smZ, amn, smn), contributions, probabilities, weights
+    return amZ, smZ, amn, smn
+
+
+# chooses branches to be evolved from their probabilities
+# exhaustive evolves all of them, prune only these with
+# probability at least threshold, sample draws shots outcomes
+# and weights them so that the sums are unbiased estimates,
+# kets tells that the branches are state vectors, whose
+# overlaps are not bounded by probabilities so they can't be pruned
+def branchWeights(
+        probabilities, branches='exhaustive',
+        threshold=1e-06, shots=100, rng=np.random, kets=False):
+    p = np.real(np.array(probabilities))
+    if branches == 'exhaustive':
+        return {b: 1. for b in range(len(p))}
+    if branches == 'prune':
+        if kets:
+            raise Exception('Pruning is supported for density matrices only')
+        return {b: 1. for b in range(len(p)) if p[b] >= threshold}
+    if branches == 'sample':
+        p = p/np.sum(p)
+        draws = rng.choice(len(p), size=shots, p=p)
+        counts = np.bincount(draws, minlength=len(p))
+        return {b: counts[b]/(shots*p[b]) for b in np.nonzero(counts)[0]}
+    raise Exception('Branch policy must be one of: exhaustive, prune, sample')
+
+
+# error of fidelities computed from a subset of branches, for
+# pruned branches it is a bound, the dropped probability eps
+# changes a fidelity A/S by at most eps/(S + eps) as the overlap
+# of every branch is bounded by its probability (which holds for
+# density matrices only, see branchWeights), for sampled ones it
+# is the standard error, which needs at least two shots
+def branchErrors(
+        sums, contributions, probabilities, weights,
+        branches='exhaustive', shots=100):
+    amZ, smZ, amn, smn = sums
+    p = np.real(np.array(probabilities))
+    if branches == 'exhaustive':
+        return 0., 0.
+    if branches == 'prune':
+        eps = np.sum([p[b] for b in range(len(p)) if b not in weights])
+        return eps/(smZ + eps), eps/(smn + eps)
+    errZ = 0.
+    errn = 0.
+    for b, w in weights.items():
+        count = w*shots*p[b]
+        y = contributions[b]/p[b]
+        errZ += count*(y[0] - amZ/smZ*y[1])**2
+        errn += count*(y[2] - amn/smn*y[3])**2
+    errZ = np.sqrt(errZ/(shots - 1.)/shots)/smZ
+    errn = np.sqrt(errn/(shots - 1.)/shots)/smn
+    return errZ, errn
+
+
+# derivatives of the fidelities amZ/smZ and amn/smn
+# from the derivatives of the sums, quotient rule
+def fidelityDerivatives(sums, dsums):
+    amZ, smZ, amn, smn = sums
+    dZ = {}
+    dn = {}
+    for k, (damZ, dsmZ, damn, dsmn) in dsums.items():
+        dZ[k] = (damZ*smZ - amZ*dsmZ)/smZ**2
+        dn[k] = (damn*smn - amn*dsmn)/smn**2
+    return dZ, dn
+
+
+# mean fidelity of the ensemble and its standard error, a single
+# member (the unperturbed run of reduced precision) has no error
+def ensembleFidelity(am, sm):
+    f = np.real(am/sm)
+    if len(f) < 2:
+        return np.mean(f), 0.
+    return np.mean(f), np.std(f, ddof=1)/np.sqrt(len(f))
+
+
+# in sensitivity mode collapse operators are c_ops = sqrt(gamma)*dc_ops
+# and dictionaries of derivatives of both fidelities are returned as well,
+# keys are 'gamma' and (name, index) of the stage whose time is varied,
+# the latter are skipped when times is False, which saves a tangent
+# per stage when only the gamma derivatives are needed,
+# in ensemble mode mean fidelities are returned with their standard errors,
+# with branches other than exhaustive (see branchWeights) only some
+# outcomes of the first measurement are evolved and fidelities are
+# returned with their error bounds or standard errors, dtype other
+# than complex128 runs the evolution on the array path (qutip solvers
+# work in double precision), a single run being an ensemble of one
+# sample without timing errors, jitter averages overlaps and success
+# probabilities over relative timing errors of that width at the cost
+# of about one run, the general fidelity is then the exact ensemble
+# mean, the post-selected one is the one of the averaged channel
+def simulateTeleportation(
+        psi,
+        Ftel,
+        FXX,
+        FZ,
+        Fdec,
+        normalize=True, c_ops=[], sensitivity=False, dc_ops=[],
+        ensemble=None, branches='exhaustive',
+        threshold=1e-06, shots=100, seed=None, dtype=np.complex128,
+        times=True, jitter=0.):
+    if branches != 'exhaustive' and (sensitivity or ensemble is not None):
+        raise Exception('Branch policies support plain runs only')
+    if jitter > 0. and (sensitivity or ensemble is not None or dtype != np.complex128):
+        raise Exception('Averaged timing errors support plain double precision runs only')
+    if branches == 'sample' and shots < 2:
+        raise Exception('Sampling branches needs at least two shots')
+    if dtype != np.complex128:
+        if sensitivity or branches != 'exhaustive':
+            raise Exception('Reduced precision supports plain and ensemble runs only')
+        if ensemble is None:
+            ampZ, ampn, _, _ = simulateTeleportation(
+                psi, Ftel, FXX, FZ, Fdec, c_ops=c_ops,
+                ensemble=timingErrors(0., 1), dtype=dtype)
+            return ampZ, ampn
+    if branches != 'exhaustive':
+        select = partial(
+            branchWeights, branches=branches, threshold=threshold,
+            shots=shots, rng=np.random.RandomState(seed))
+        sums, contributions, probabilities, weights = teleportationAmplitudes(
+            psi, Ftel, FXX, FZ, Fdec, c_ops=c_ops, select=select,
+            jitter=jitter)
+        amZ, smZ, amn, smn = sums
+        errZ, errn = branchErrors(
+            sums, contributions, probabilities, weights,
+            branches=branches, shots=shots)
+        return amZ / smZ, amn / smn, errZ, errn
+    if ensemble is not None:
+        amZ, smZ, amn, smn = teleportationAmplitudes(
+            psi, Ftel, FXX, FZ, Fdec, c_ops=c_ops,
+            ensemble=ensemble, dtype=dtype)
+        ampZ, errZ = ensembleFidelity(amZ, smZ)
+        ampn, errn = ensembleFidelity(amn, smn)
+        return ampZ, ampn, errZ, errn
+    if sensitivity:
+        sums, dsums = teleportationAmplitudes(
+            psi, Ftel, FXX, FZ, Fdec,
+            c_ops=c_ops, sensitivity=True, dc_ops=dc_ops, times=times)
+        amZ, smZ, amn, smn = sums
+        dZ, dn = fidelityDerivatives(sums, dsums)
+        return amZ / smZ, amn / smn, dZ, dn
+    amZ, smZ, amn, smn = teleportationAmplitudes(
+        psi, Ftel, FXX, FZ, Fdec, c_ops=c_ops, jitter=jitter)
     ampZ = 0.
     ampn = 0.
     ampZ = amZ / smZ
     ampn = amn / smn
     return ampZ, ampn
+
+
+# fidelity averaged over all the pure input states, for density
+# matrices (any c_ops) the fidelity is quadratic in the input state
+# so averaging over the six Bloch states (a 2-design, states can
+# replace them by another one) gives the exact Haar average,
+# state vectors (no c_ops) use |overlap| and solver normalized
+# branches, which are not quadratic, so there it is only an estimate,
+# post-selected fidelity is the one of the heralded channel,
+# overlaps and success probabilities are averaged separately,
+# so are timing errors with jitter (see simulateTeleportation)
+def averageTeleportation(
+        Ftel,
+        FXX,
+        FZ,
+        Fdec,
+        c_ops=[], sensitivity=False, dc_ops=[], ensemble=None,
+        dtype=np.complex128, states=None, times=True, jitter=0.):
+    if jitter > 0. and (sensitivity or ensemble is not None or dtype != np.complex128):
+        raise Exception('Averaged timing errors support plain double precision runs only')
+    if states is None:
+        states = bloch(basis(2, 0), basis(2, 1))
+    if dtype != np.complex128:
+        if sensitivity:
+            raise Exception('Reduced precision supports plain and ensemble runs only')
+        if ensemble is None:
+            ampZ, ampn, _, _ = averageTeleportation(
+                Ftel, FXX, FZ, Fdec, c_ops=c_ops,
+                ensemble=timingErrors(0., 1), dtype=dtype, states=states)
+            return ampZ, ampn
+    sums = 0.
+    dsums = {}
+    for psi in states:
+        if sensitivity:
+            s, ds = teleportationAmplitudes(
+                psi, Ftel, FXX, FZ, Fdec,
+                c_ops=c_ops, sensitivity=True, dc_ops=dc_ops, times=times)
+            for k, v in ds.items():
+                dsums[k] = dsums.get(k, 0.) + v
+        else:
+            s = teleportationAmplitudes(
+                psi, Ftel, FXX, FZ, Fdec, c_ops=c_ops,
+                ensemble=ensemble, dtype=dtype, jitter=jitter)
+        sums = sums + np.real(np.array(s))
+    amZ, smZ, amn, smn = sums
+    if ensemble is not None:
+        ampZ, errZ = ensembleFidelity(amZ, smZ)
+        ampn, errn = ensembleFidelity(amn, smn)
+        return ampZ, ampn, errZ, errn
+    ampZ = amZ / smZ
+    ampn = amn / smn
+    if sensitivity:
+        dZ, dn = fidelityDerivatives(sums, dsums)
+        return ampZ, ampn, dZ, dn
+    return ampZ, ampn